@@ -0,0 +1,5 @@
+"""Run clant as a module with `python -m clant`."""
+
+from clant.clant import main
+
+main()
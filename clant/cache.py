@@ -0,0 +1,204 @@
+"""
+Caching of data between runs.
+
+Cached data is stored as pickle files in the user's cache directory, and
+written atomically so that concurrent runs never see partial files.  Tool
+results are validated using the dependency files written by the build.
+"""
+
+import functools
+import hashlib
+import os
+import pickle
+import re
+import shutil
+import tempfile
+
+# Version of the format of cached tool results
+_RESULT_FORMAT = 1
+
+# Patterns for splitting the prerequisites in a make-style dependency file
+_DEPFILE_SPLIT_RE = re.compile(r"(?<!\\)\s+")
+_DEPFILE_ESCAPE_RE = re.compile(r"\\([ #])|\$(\$)")
+
+
+def cache_dir():
+    """Return the path of the directory for cached data."""
+
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    if not cache_home:
+        cache_home = os.path.join(os.path.expanduser("~"), ".cache")
+
+    return os.path.join(cache_home, "clant")
+
+
+def load(path):
+    """Load and return an object from a cache file, or None."""
+
+    try:
+        with open(path, "rb") as cache_file:
+            return pickle.load(cache_file)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+
+
+def write_file(path, data):
+    """Atomically write bytes to a file, or raise OSError."""
+
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path), delete=False
+        ) as tmp:
+            tmp_path = tmp.name
+            tmp.write(data)
+
+        os.replace(tmp_path, path)
+    except OSError:
+        if tmp_path is not None:
+            os.remove(tmp_path)
+
+        raise
+
+
+def save(path, value):
+    """Atomically save an object to a cache file, or raise OSError."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file(path, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def _stat_stamp(path):
+    """Return a (path, mtime, size) tuple used to detect changes to a file."""
+
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=None)
+def _tool_path(name):
+    """Return the path of a tool executable, or the name if it isn't found."""
+
+    path = shutil.which(name)
+    return name if path is None else path
+
+
+def _get_depfile(command):
+    """Return the dependency file written by a compile command, or None."""
+
+    args = iter(command)
+    output = None
+    writes_deps = False
+    for arg in args:
+        if arg == "-MF":
+            return next(args, None)
+
+        if arg.startswith("-MF"):
+            return arg[3:]
+
+        if arg == "-o":
+            output = next(args, None)
+        elif arg in ("-MD", "-MMD"):
+            writes_deps = True
+
+    if writes_deps and output is not None:
+        return os.path.splitext(output)[0] + ".d"
+
+    return None
+
+
+def _read_depfile(path):
+    """Return a list of all prerequisites in a make-style dependency file."""
+
+    with open(path, "r", encoding="utf-8", errors="surrogateescape") as dep:
+        text = dep.read().replace("\\\n", " ")
+
+    deps = []
+    for line in text.splitlines():
+        _, separator, prerequisites = line.partition(": ")
+        if separator:
+            deps += [
+                _DEPFILE_ESCAPE_RE.sub(r"\1\2", d)
+                for d in _DEPFILE_SPLIT_RE.split(prerequisites.strip())
+                if d
+            ]
+
+    return deps
+
+
+def _get_dependencies(build_dir, command):
+    """
+    Return stamps for all the files a compiled source depends on, or None.
+
+    The dependencies are read from the file written by the build, so this is
+    None if there is no such file, or if it is older than a dependency.
+    """
+
+    depfile = _get_depfile(command)
+    if depfile is None:
+        return None
+
+    depfile = os.path.join(build_dir, depfile)
+    deps = [
+        _stat_stamp(os.path.join(build_dir, d)) for d in _read_depfile(depfile)
+    ]
+    mtime = os.stat(depfile).st_mtime_ns
+    if len(deps) == 0 or any(d[1] > mtime for d in deps):
+        return None
+
+    return deps
+
+
+def result_entry(build_dir, cmd, source, command, config_files):
+    """
+    Return a (path, dependencies) tuple for caching the result of a tool.
+
+    The path is named by a hash of the command, tool, configuration files,
+    and source contents, and the dependencies are stamps of every file listed
+    in the source's dependency file.  A result is only valid if both match.
+    Both are None if the dependencies of the source aren't known.
+    """
+
+    try:
+        deps = _get_dependencies(build_dir, command)
+        if deps is None:
+            return (None, None)
+
+        digest = hashlib.blake2b()
+        for arg in [build_dir, *cmd, "", *command]:
+            digest.update(arg.encode("utf-8", "surrogateescape") + b"\0")
+
+        for path in [_tool_path(cmd[0])] + config_files:
+            digest.update(repr(_stat_stamp(path)).encode("utf-8"))
+
+        with open(os.path.join(build_dir, source), "rb") as source_file:
+            digest.update(source_file.read())
+    except (OSError, ValueError):
+        return (None, None)
+
+    key = digest.hexdigest()
+    return (os.path.join(cache_dir(), "results", f"{key}.pickle"), deps)
+
+
+def load_result(path, deps):
+    """Load a cached (returncode, stdout, stderr, duration) tuple, or None."""
+
+    entry = load(path)
+    if isinstance(entry, tuple) and len(entry) == 6:
+        if entry[0] == _RESULT_FORMAT and entry[1] == deps:
+            return entry[2:]
+
+    return None
+
+
+def make_result(deps, proc, duration):
+    """Return an object for caching the result of a tool with save()."""
+
+    return (
+        _RESULT_FORMAT,
+        deps,
+        proc.returncode,
+        proc.stdout,
+        proc.stderr,
+        duration,
+    )
@@ -5,18 +5,34 @@ Check for C and C++ code issues with clang-based tools.
 """
 
 import argparse
+import asyncio
 import collections
-import glob
+import concurrent.futures
+import functools
+import hashlib
+import io
 import json
-import multiprocessing
 import os
-import queue
 import re
-import shlex
 import shutil
 import subprocess
 import sys
-import threading
+import time
+
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+try:
+    from . import cache as _cache
+except ImportError:
+    import cache as _cache  # Running as a script
+
+try:
+    from . import shell as _shell
+except ImportError:
+    import shell as _shell  # Running as a script
 
 __author__ = "David Robillard"
 __date__ = "2020-12-13"
@@ -34,10 +50,11 @@ class ConfigurationError(RuntimeError):
 
 # Options that may be used by a task
 _Options = collections.namedtuple(
-    "Options",
+    "_Options",
     [
         "auto_headers",
         "build_dir",
+        "cache",
         "headers",
         "include_flags",
         "mapping_files",
@@ -45,7 +62,66 @@ _Options = collections.namedtuple(
     ],
 )
 
-_Task = collections.namedtuple("Task", ["func", "source", "command"])
+_Task = collections.namedtuple("_Task", ["func", "source", "command"])
+
+# Common command line prefixes for running tools
+_TIDY_COMMAND = (
+    "clang-tidy",
+    '--warnings-as-errors="*"',
+    "--quiet",
+    "-p=.",
+)
+_IWYU_COMMAND = ("include-what-you-use", "-Xiwyu", "--quoted_includes_first")
+
+# Name of task times file in the build directory
+_TIMES_NAME = ".clant_times.json"
+
+# Programs that may wrap the compiler at the start of a compile command
+_COMPILER_WRAPPERS = frozenset(["ccache", "distcc", "icecc", "sccache"])
+
+# File name suffixes of extra headers to check
+_HEADER_SUFFIXES = (".h", ".hh", ".hpp", ".ipp")
+
+# Types of configuration values as (value type, element type) pairs
+_CONFIGURATION_TYPES = {
+    "auto_headers": (bool, None),
+    "build_dir": (str, None),
+    "cache": (bool, None),
+    "exclude_patterns": (list, str),
+    "headers": (bool, None),
+    "include_dirs": (list, str),
+    "iwyu": (bool, None),
+    "jobs": (int, None),
+    "mapping_files": (list, str),
+    "tidy": (bool, None),
+    "verbose": (bool, None),
+}
+
+# Extensions of headers to check with clang-tidy for each source file suffix
+_HEADER_EXTENSIONS = {
+    ".c": ("h",),
+    ".m": ("h",),
+    ".cpp": ("hpp", "hh", "ipp"),
+    ".cc": ("hpp", "hh", "ipp"),
+}
+
+# States for parsing include-what-you-use output
+_IWYU_GENERAL, _IWYU_ADD, _IWYU_REMOVE, _IWYU_LIST = range(4)
+
+# Pattern for a non-blank line of include-what-you-use output, where the name
+# of the last matched group is the kind of line, or "other" for general lines
+_IWYU_LINE_RE = re.compile(
+    rb"^(?:"
+    rb"(?P<end>---)"
+    rb"|(?P<list>The full include-list for .*)"
+    rb"|\((?P<correct>.*?) has correct #includes/fwd-decls\)"
+    rb"|(?P<add>.*?) should add these lines:"
+    rb"|(?P<remove>.*?) should remove these lines:"
+    rb"|(?P<removal>- (?P<text>.*?)  // lines (?P<number>[0-9]+)-[0-9]+)"
+    rb"|(?P<other>.*\S.*)"
+    rb")$",
+    re.MULTILINE,
+)
 
 
 def _message(string):
@@ -62,26 +138,83 @@ def _warning(string):
     sys.stderr.flush()
 
 
-def _run_command(options, cmd):
+def _command_echo(options, cmd):
+    """Return the output line that shows a command if running verbosely."""
+
+    if not options.verbose:
+        return b""
+
+    return f"{_shell.join(cmd)}\n".encode("utf-8")
+
+
+async def _run_command(options, cmd):
     """Run a command and return a CompletedProcess with captured output."""
 
-    if options.verbose:
-        sys.stdout.write(f"{shlex.join(cmd)}\n")
+    # Descriptors are not inheritable by default, so there's no need to pay
+    # for closing them all in the child, which also allows a faster spawn
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        cwd=options.build_dir,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        close_fds=False,
+    )
 
-    return subprocess.run(cmd, capture_output=True, check=False)
+    stdout, stderr = await proc.communicate()
 
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
 
-def _load_compdb(path):
+
+def _save_cache_file(path, value):
+    """Atomically save an object to a cache file if possible."""
+
+    try:
+        _cache.save(path, value)
+    except OSError as error:
+        _warning(f"Failed to write cache file `{path}' ({error})")
+
+
+async def _run_tool(options, cmd, source, command, config_files):
     """
-    Load and return the compilation database as a Python object.
+    Run a tool on a source file, or reuse the result of a previous run.
+
+    Results of sources with a compile command are cached unless caching is
+    disabled, and reused only if nothing they depend on has changed.
 
-    It is assumed that the current directory is already the build directory.
+    Returns a (CompletedProcess, duration, cached) tuple, where cached is
+    true if the tool wasn't actually run.
     """
 
-    _message(f"Loading compilation database `{path}'")
+    cache_path, deps = None, None
+    if options.cache and command is not None:
+        cache_path, deps = _cache.result_entry(
+            options.build_dir, cmd, source, command, config_files
+        )
 
-    with open("compile_commands.json", "r", encoding="utf-8") as compdb_file:
-        return json.load(compdb_file)
+    cached = (
+        None if cache_path is None else _cache.load_result(cache_path, deps)
+    )
+    if cached is not None:
+        returncode, stdout, stderr, duration = cached
+        proc = subprocess.CompletedProcess(cmd, returncode, stdout, stderr)
+        return (proc, duration, True)
+
+    start = time.monotonic()
+    proc = await _run_command(options, cmd)
+    duration = time.monotonic() - start
+
+    if cache_path is not None and proc.returncode >= 0:
+        _save_cache_file(cache_path, _cache.make_result(deps, proc, duration))
+
+    return (proc, duration, False)
+
+
+def _load_compdb(path):
+    """Load and return the compilation database as a Python object."""
+
+    with open(path, "rb") as compdb_file:
+        return _json_loads(compdb_file.read())
 
 
 def _get_compile_commands(compdb):
@@ -96,9 +229,9 @@ def _get_compile_commands(compdb):
         if "arguments" in entry:
             command = entry["arguments"]
         elif "command" in entry:
-            command = shlex.split(entry["command"])
+            command = _shell.split(entry["command"])
 
-        if command[0] == "ccache":
+        if command[0] in _COMPILER_WRAPPERS:
             command = command[1:]
 
         commands[entry["file"]] = command
@@ -106,6 +239,34 @@ def _get_compile_commands(compdb):
     return commands
 
 
+def _load_compile_commands(path, use_cache=True):
+    """
+    Load a dictionary of compile commands from a compilation database.
+
+    The commands are cached unless `use_cache` is false, so the database is
+    only parsed again when its modification time or size (or the version of
+    clant) has changed since the last run.
+    """
+
+    _message(f"Loading compilation database `{path}'")
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = hashlib.sha256(path.encode("utf-8")).hexdigest()
+    cache_path = os.path.join(_cache.cache_dir(), f"compdb-{key}.pickle")
+    stamp = (__version__, stat.st_mtime_ns, stat.st_size)
+
+    cached = _cache.load(cache_path) if use_cache else None
+    if isinstance(cached, tuple) and len(cached) == 2 and cached[0] == stamp:
+        return cached[1]
+
+    commands = _get_compile_commands(_load_compdb(path))
+    if use_cache:
+        _save_cache_file(cache_path, (stamp, commands))
+
+    return commands
+
+
 def _get_include_flags(commands):
     """
     Return a list of all include flags used in the compilation.
@@ -117,10 +278,8 @@ def _get_include_flags(commands):
     """
 
     include_flags = set()
-    for _, command in commands.items():
-        flags = [f for f in command if f.startswith("-I")]
-        for flag in flags:
-            include_flags.add(flag)
+    for command in commands.values():
+        include_flags.update(f for f in command if f.startswith("-I"))
 
     return list(include_flags)
 
@@ -135,204 +294,273 @@ def _get_header_files(include_dirs):
     """Return a list of all extra headers to include in checks."""
 
     headers = []
-    for path in include_dirs:
-        headers += glob.glob(path + "/**/*.h", recursive=True)
-        headers += glob.glob(path + "/**/*.hh", recursive=True)
-        headers += glob.glob(path + "/**/*.hpp", recursive=True)
-        headers += glob.glob(path + "/**/*.ipp", recursive=True)
+    stack = list(include_dirs)
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(_HEADER_SUFFIXES):
+                        headers.append(entry.path)
+        except OSError:
+            continue
 
     return headers
 
 
-def _header_extensions(source):
-    """Return a list of header extensions to also check for a source file."""
+@functools.lru_cache(maxsize=None)
+def _header_filter(suffix):
+    """Return the clang-tidy header filter for a source file suffix."""
 
-    if source.endswith(".c") or source.endswith(".m"):
-        return ["h"]
+    extensions = _HEADER_EXTENSIONS.get(suffix, ())
+    return "|".join([f".*\\.{x}$" for x in extensions])
 
-    if source.endswith(".cpp") or source.endswith(".cc"):
-        return ["hpp", "hh", "ipp"]
 
-    return []
+@functools.lru_cache(maxsize=None)
+def _tidy_config_files(directory):
+    """Return the clang-tidy configuration files that apply in a directory."""
 
+    parent = os.path.dirname(directory)
+    files = [] if parent == directory else _tidy_config_files(parent)
 
-def _run_clang_tidy(options, source, command, lock):
-    """Run clang-tidy on a file in a thread."""
+    path = os.path.join(directory, ".clang-tidy")
+    return files + [path] if os.path.exists(path) else files
 
-    # pylint: disable=unused-argument
 
-    cmd = [
-        "clang-tidy",
-        '--warnings-as-errors="*"',
-        "--quiet",
-        "-p=.",
-    ]
+async def _run_clang_tidy(options, source, command):
+    """Run clang-tidy on a file and return (status, output, duration)."""
+
+    cmd = list(_TIDY_COMMAND)
 
     if options.auto_headers:
-        extensions = _header_extensions(source)
-        pattern = "|".join([f".*\\.{x}$" for x in extensions])
+        pattern = _header_filter(os.path.splitext(source)[1])
         cmd += [f"--header-filter={pattern}"]
 
     cmd += [source]
 
-    proc = _run_command(options, cmd)
+    source_dir = os.path.dirname(os.path.join(options.build_dir, source))
+    config_files = _tidy_config_files(os.path.normpath(source_dir))
 
-    with lock:
-        if proc.returncode == 0:
-            sys.stdout.write(f"{source}:1:1: note: code is tidy\n")
-        else:
-            print(f"{source}:1:1: error: clang-tidy issues from here:")
+    proc, duration, cached = await _run_tool(
+        options, cmd, source, command, config_files
+    )
+    echo = b"" if cached else _command_echo(options, cmd)
 
-        if len(proc.stdout) > 0:
-            sys.stdout.write(proc.stdout.decode("utf-8"))
+    if proc.returncode == 0:
+        output = f"{source}:1:1: note: code is tidy\n"
+    else:
+        output = f"{source}:1:1: error: clang-tidy issues from here:\n"
 
-    return proc.returncode
+    output = echo + output.encode("utf-8") + proc.stdout
+    return (proc.returncode, output, duration)
 
 
-def _iwyu_output_formatter(output):
+def _iwyu_output_formatter(output, write):
     """Convert IWYU output to standard compiler format.
 
-    General idea taken from iwyu_tool.py.  This implementation is a bit more
-    modern and tidy (in my opinion), and appeases pylint.
+    The output is processed as bytes, so lines are never decoded, and each
+    converted line is passed to `write` as it is produced.  Returns true if
+    any errors were found.  General idea taken from iwyu_tool.py.  This
+    implementation is a bit more modern and tidy (in my opinion), and
+    appeases pylint.
     """
 
-    result = []
+    state = _IWYU_GENERAL
+    path = None
+    has_errors = False
+    for match in _IWYU_LINE_RE.finditer(output):
+        line = match.group()
+        kind = match.lastgroup
+
+        if kind == "end":
+            state = _IWYU_GENERAL
+        elif kind == "list":
+            state = _IWYU_LIST
+        elif kind == "correct":
+            write(b"%s:1:1: note: includes are correct\n" % match.group(kind))
+            state = _IWYU_GENERAL
+        elif kind == "add":
+            state, path = _IWYU_ADD, match.group(kind)
+        elif kind == "remove":
+            state, path = _IWYU_REMOVE, match.group(kind)
+        elif state == _IWYU_GENERAL:
+            write(line + b"\n")
+        elif state == _IWYU_ADD:
+            has_errors = True
+            write(b"%s:1:1: error: add the following line\n" % path)
+            write(line + b"\n")
+        elif state == _IWYU_REMOVE:
+            has_errors = True
+            number = b"1"
+            if kind == "removal":
+                number, line = match.group("number", "text")
 
-    # States for parsing context
-    General = collections.namedtuple("General", [])
-    Add = collections.namedtuple("Add", ["path"])
-    Remove = collections.namedtuple("Remove", ["path"])
-    List = collections.namedtuple("List", [])
+            write(b"%s:%s:1: error: remove this line\n" % (path, number))
+            write(line + b"\n")
 
-    def next_state(state, line):
-        correct_re = re.compile(r"^\((.*?) has correct #includes/fwd-decls\)$")
-        should_add_re = re.compile(r"^(.*?) should add these lines:$")
-        should_remove_re = re.compile(r"^(.*?) should remove these lines:$")
+    return has_errors
 
-        if line == "---":
-            return (General(), True)
 
-        if line.startswith("The full include-list for"):
-            return (List(), True)
+async def _run_iwyu(options, source, command):
+    """Run include-what-you-use on a file and return (status, output, time)."""
 
-        match = correct_re.match(line)
-        if match:
-            path = match.group(1)
-            result.append(f"{path}:1:1: note: includes are correct")
-            return (General(), True)
+    cmd = list(_IWYU_COMMAND)
 
-        match = should_add_re.match(line)
-        if match:
-            return (Add(match.group(1)), True)
+    for mapping_file in options.mapping_files:
+        cmd += ["-Xiwyu", "--mapping_file=" + mapping_file]
 
-        match = should_remove_re.match(line)
-        if match:
-            return (Remove(match.group(1)), True)
+    if command is None:
+        # Run on extra header using the aggregated include flags
+        cmd += options.include_flags + [source]
+    else:
+        # Run on normal source file with a compile command
+        cmd += command[1:]
 
-        return (state, False)
+    config_files = [
+        os.path.join(options.build_dir, f) for f in options.mapping_files
+    ]
 
-    lines_re = re.compile(r"^- (.*?)  // lines ([0-9]+)-[0-9]+$")
+    proc, duration, cached = await _run_tool(
+        options, cmd, source, command, config_files
+    )
 
-    state = General()
-    has_errors = False
-    for line in output.splitlines():
-        if len(line.strip()) == 0:
-            continue
+    output = io.BytesIO()
+    if not cached:
+        output.write(_command_echo(options, cmd))
 
-        state, changed = next_state(state, line)
-        if changed:
-            continue
+    echo_size = output.tell()
+    has_errors = _iwyu_output_formatter(proc.stderr, output.write)
 
-        if isinstance(state, General):
-            result.append(line)
-        elif isinstance(state, Add):
-            has_errors = True
-            result.append(f"{state.path}:1:1: error: add the following line")
-            result.append(line)
-        elif isinstance(state, Remove):
-            has_errors = True
-            match = lines_re.match(line)
-            line = match.group(2) if match else "1"
-            result.append(f"{state.path}:{line}:1: error: remove this line")
-            result.append(match.group(1))
+    if output.tell() == echo_size:
+        message = f"{source}:1:1: warning: include-what-you-use failed\n"
+        output.write(message.encode("utf-8"))
 
-    return (result, has_errors)
+    return (1 if has_errors else 0, output.getvalue(), duration)
 
 
-def _run_iwyu(options, source, command, lock):
-    """Run include-what-you-use on a file in a thread."""
+async def _run_worker(options, tasks, times):
+    """Run tasks from a shared iterator until there are none left.
 
-    cmd = ["include-what-you-use", "-Xiwyu", "--quoted_includes_first"]
+    The output of each task is printed as soon as it finishes, and the time
+    it took is added to the total for its source in `times`.  Returns 1 if
+    any task failed, otherwise 0.
+    """
 
-    for mapping_file in options.mapping_files:
-        cmd += ["-Xiwyu", "--mapping_file=" + mapping_file]
+    status = 0
+    for task in tasks:
+        returncode, output, duration = await task.func(
+            options, task.source, task.command
+        )
 
-    if command is None:
-        # Run on extra header using the aggregated include flags
-        cmd += options.include_flags + [source]
-        proc = _run_command(options, cmd)
-    else:
-        # Run on normal source file with a compile command
-        cmd += command[1:]
+        # Write all the output at once, so it is never interleaved with another
+        sys.stdout.buffer.write(output)
+        sys.stdout.buffer.flush()
+
+        if returncode != 0:
+            status = 1
+
+        times[task.source] = times.get(task.source, 0.0) + duration
 
-        proc = _run_command(options, cmd)
+    return status
 
-    sensible_output, has_errors = _iwyu_output_formatter(
-        proc.stderr.decode("utf-8")
+
+async def _run_all_tasks(options, tasks, num_jobs):
+    """Run tasks in num_jobs workers and return a (status, times) tuple."""
+
+    times = {}
+    tasks = iter(tasks)
+    statuses = await asyncio.gather(
+        *[_run_worker(options, tasks, times) for _ in range(max(1, num_jobs))]
     )
 
-    with lock:
-        if len(sensible_output) == 0:
-            print(f"{source}:1:1: warning: include-what-you-use failed")
-        else:
-            print(os.linesep.join(sensible_output))
+    return (max(statuses), times)
 
-    return 1 if has_errors else 0
 
+def _run_tasks(options, tasks, num_jobs):
+    """Run tasks with at most num_jobs tools running at once.
 
-def _task_thread(task_queue, error_queue, options, lock):
-    """Thread that executes tasks from a queue until the queue is empty."""
+    All tools are driven by a single event loop in this process, which
+    formats the output of each task and prints it as soon as it finishes.
+    Tasks may be any iterable, which is only consumed as jobs become free.
 
-    while not task_queue.empty():
-        task = task_queue.get()
+    Returns a (status, times) tuple, where times is a dictionary that maps
+    each source to the total time taken by its tasks.
+    """
 
-        if task.func(options, task.source, task.command, lock) != 0:
-            error_queue.put(1)
+    return asyncio.run(_run_all_tasks(options, tasks, num_jobs))
 
-        task_queue.task_done()
 
+def _generate_tasks(files, funcs):
+    """Generate tasks to run every tool function on every (source, command)."""
 
-def _run_threads(options, tasks, num_jobs):
-    """Launch threads to run tasks and wait until all tasks are completed."""
+    for source, command in files:
+        for func in funcs:
+            yield _Task(func, source, command)
 
-    # Put all tasks in a queue
-    task_queue = queue.Queue(len(tasks))
-    for task in tasks:
-        task_queue.put(task)
-
-    # Make a queue for error returns so we can exit with an appropriate code
-    error_queue = queue.Queue(len(tasks))
-
-    # Launch a set of threads to run tasks in parallel
-    num_jobs = min(num_jobs, task_queue.qsize())
-    lock = threading.Lock()
-    threads = []
-    for _ in range(num_jobs):
-        thread = threading.Thread(
-            target=_task_thread,
-            args=(task_queue, error_queue, options, lock),
-            daemon=True,
-        )
 
-        thread.start()
-        threads += [thread]
+def _load_task_times(path):
+    """Load the valid task times recorded by a previous run, if any."""
 
-    # Wait until everything is finished
-    task_queue.join()
-    for thread in threads:
-        thread.join()
+    try:
+        with open(path, "rb") as times_file:
+            times = _json_loads(times_file.read())
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(times, dict):
+        return {}
+
+    return {k: v for k, v in times.items() if isinstance(v, (int, float))}
 
-    return 0 if error_queue.empty() else 1
+
+def _save_task_times(path, times):
+    """Save task times for scheduling the next run, if possible."""
+
+    rounded = {k: round(v, 3) for k, v in times.items()}
+    text = json.dumps(rounded, indent=0, sort_keys=True)
+
+    try:
+        _cache.write_file(path, text.encode("utf-8"))
+    except OSError as error:
+        _warning(f"Failed to save task times ({error})")
+
+
+def _sort_files(files, times, build_dir):
+    """
+    Sort (source, command) pairs so the most expensive are checked first.
+
+    Starting the longest tasks first avoids the run being held up at the end
+    by a single big translation unit while other jobs sit idle.  Sources with
+    times from a previous run are ordered by those, other sources are assumed
+    to be more expensive and ordered by size, and unmeasured headers are
+    assumed to be cheap.
+    """
+
+    def cost(file):
+        source, command = file
+        if source in times:
+            return (1, times[source])
+
+        if command is None:
+            return (0, 0)
+
+        try:
+            return (2, os.path.getsize(os.path.join(build_dir, source)))
+        except OSError:
+            return (2, 0)
+
+    files.sort(key=cost, reverse=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _skip_regex(patterns):
+    """Return a compiled regex that matches any of a tuple of patterns."""
+
+    return re.compile("|".join(patterns))
 
 
 def _filter_files(sources, headers, exclude_patterns):
@@ -342,19 +570,32 @@ def _filter_files(sources, headers, exclude_patterns):
     Returns a (sources, headers) tuple.
     """
 
-    # Filter out explicitly excluded files
+    # Filter out excluded sources and sources in the build directory, the
+    # latter avoids checking generated code, configuration checks, and so on
+    skip_re = _skip_regex(tuple(exclude_patterns) + (r"^(?!\.\.)",))
+    sources = [s for s in sources if not skip_re.search(s)]
+
+    # Filter out explicitly excluded headers
     if len(exclude_patterns) > 0:
-        exclude_re = re.compile("|".join(exclude_patterns))
-        sources = [s for s in sources if not exclude_re.search(s)]
+        exclude_re = _skip_regex(tuple(exclude_patterns))
         headers = [h for h in headers if not exclude_re.search(h)]
 
-    # Filter out sources in the build directory
-    # This avoids checking generated code, configuration checks, and so on
-    sources = [s for s in sources if s.startswith("..")]
-
     return (sources, headers)
 
 
+@functools.lru_cache(maxsize=None)
+def _iwyu_data_dir():
+    """Return the system include-what-you-use data directory if found."""
+
+    iwyu_path = shutil.which("include-what-you-use")
+    if iwyu_path is None:
+        return None
+
+    prefix = os.path.dirname(os.path.dirname(iwyu_path))
+    return os.path.join(prefix, "share", "include-what-you-use")
+
+
+@functools.lru_cache(maxsize=None)
 def find_mapping_file(project_dir, name):
     """
     Find an include-what-you-use mapping file.
@@ -372,27 +613,37 @@ def find_mapping_file(project_dir, name):
         _message(f"Using mapping file `{in_project}'")
         return in_project
 
-    iwyu_path = shutil.which("include-what-you-use")
-    prefix = os.path.dirname(os.path.dirname(iwyu_path))
-    on_system = os.path.join(prefix, "share", "include-what-you-use", name)
-    if os.path.exists(on_system):
-        _message(f"Using mapping file `{on_system}'")
-        return on_system
+    data_dir = _iwyu_data_dir()
+    if data_dir is not None:
+        on_system = os.path.join(data_dir, name)
+        if os.path.exists(on_system):
+            _message(f"Using mapping file `{on_system}'")
+            return on_system
 
     raise FileNotFoundError(f"Could not find mapping file `{name}'")
 
 
+def _cpu_count():
+    """Return the number of CPUs this process is allowed to run on."""
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
 def _default_configuration():
     """Return a default configuration dictionary."""
 
     return {
         "auto_headers": True,
         "build_dir": "build",
+        "cache": True,
         "exclude_patterns": [],
         "headers": True,
         "include_dirs": [],
         "iwyu": True,
-        "jobs": multiprocessing.cpu_count(),
+        "jobs": _cpu_count(),
         "mapping_files": [],
         "tidy": True,
         "verbose": False,
@@ -416,6 +667,7 @@ def _update_configuration(config, update):
         if key in [
             "auto_headers",
             "build_dir",
+            "cache",
             "headers",
             "iwyu",
             "tidy",
@@ -433,6 +685,23 @@ def _update_configuration(config, update):
     return config
 
 
+def _check_configuration_value(key, value, spec):
+    """Raise a ConfigurationError if a value doesn't match a type spec."""
+
+    value_type, element_type = spec
+    if not isinstance(value, value_type):
+        raise ConfigurationError(
+            f"Value for `{key}' is not a {value_type.__name__}"
+        )
+
+    if element_type is not None:
+        for element in value:
+            if not isinstance(element, element_type):
+                raise ConfigurationError(
+                    f"Value in `{key}' is not a {element_type.__name__}"
+                )
+
+
 def _load_configuration(config_path):
     """
     Load additional configuration from a .clang.json file.
@@ -444,19 +713,6 @@ def _load_configuration(config_path):
     _message(f"Loading configuration `{config_path}'")
     project_dir = os.path.dirname(config_path)
 
-    def check_type(key, value, required_type):
-        if not isinstance(value, required_type):
-            raise ConfigurationError(
-                f"Value for `{key}' is not a {required_type.__name__}"
-            )
-
-    def check_element_type(key, value, required_type):
-        for element in value:
-            if not isinstance(element, required_type):
-                raise ConfigurationError(
-                    f"Value in `{key}' is not a {required_type.__name__}"
-                )
-
     with open(config_path, "r", encoding="utf-8") as config_file:
         file_config = json.load(config_file)
 
@@ -468,30 +724,18 @@ def _load_configuration(config_path):
             _warning(f"Configuration version {config_version} > {__version__}")
 
         for key, value in file_config.items():
-            if key == "auto_headers":
-                check_type(key, value, bool)
-            elif key == "build_dir":
-                check_type(key, value, str)
-            elif key == "headers":
-                check_type(key, value, bool)
-            elif key in ["exclude_patterns", "include_dirs"]:
-                check_type(key, value, list)
-                check_element_type(key, value, str)
-            elif key in ["iwyu", "tidy"]:
-                check_type(key, value, bool)
-            elif key == "jobs":
-                check_type(key, value, int)
-            elif key == "mapping_files":
-                check_type(key, value, list)
-                check_element_type(key, value, str)
-                file_config[key] = [
-                    find_mapping_file(project_dir, f) for f in value
-                ]
-            elif key == "verbose":
-                check_type(key, value, bool)
+            spec = _CONFIGURATION_TYPES.get(key)
+            if spec is not None:
+                _check_configuration_value(key, value, spec)
             elif key != "version":
                 _warning(f"Unknown configuration key `{key}'")
 
+        if "mapping_files" in file_config:
+            file_config["mapping_files"] = [
+                find_mapping_file(project_dir, f)
+                for f in file_config["mapping_files"]
+            ]
+
         return file_config
 
 
@@ -516,6 +760,42 @@ def _get_configuration(project_dir, args):
     return _update_configuration(config, args)
 
 
+def _load_project(build_dir, config):
+    """
+    Load the compilation database and find the files to check.
+
+    Returns a (commands, sources, headers) tuple, where all paths are relative
+    to the build directory.
+    """
+
+    # Get a list of absolute paths to all extra include dirs
+    include_dirs = []
+    if config["headers"]:
+        include_dirs = [os.path.abspath(d) for d in config["include_dirs"]]
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        # Search for extra headers in the background while loading commands
+        header_search = executor.submit(_get_header_files, include_dirs)
+
+        # Load compile commands from compilation database
+        commands = _load_compile_commands(
+            os.path.join(build_dir, "compile_commands.json"), config["cache"]
+        )
+        sources = _get_source_files(commands)
+
+        # Make headers relative to the build for consistency with sources
+        headers = [
+            os.path.relpath(h, build_dir) for h in header_search.result()
+        ]
+
+    # Filter out excluded files and files in the build directory
+    sources, headers = _filter_files(
+        sources, headers, config["exclude_patterns"]
+    )
+
+    return (commands, sources, headers)
+
+
 def run(build_dir, **kwargs):
     """
     Run checks on an entire project.
@@ -526,6 +806,8 @@ def run(build_dir, **kwargs):
 
     :param str build_dir: Path to build directory.
 
+    :param bool cache: Reuse cached results for unchanged files.
+
     :param str exclude_patterns: List of regular expressions for files to
                                  exclude from checks.
 
@@ -540,69 +822,50 @@ def run(build_dir, **kwargs):
     :param bool verbose: Print all executed commands.
     """
 
-    project_dir = os.path.dirname(os.path.abspath(build_dir))
+    build_dir = os.path.abspath(build_dir)
+    project_dir = os.path.dirname(build_dir)
     config = _get_configuration(project_dir, kwargs)
 
-    # Get a list of absolute paths to all extra include dirs
-    include_dirs = config["include_dirs"]
-    if len(include_dirs) > 0:
-        include_dirs = [os.path.abspath(d) for d in include_dirs]
-
-    # Move into the build directory
-    orig_cwd = os.getcwd()
-    _message(f"Entering directory `{os.path.abspath(build_dir)}'")
-    os.chdir(build_dir)
-
-    # Make include dirs relative to the build for consistency with sources
-    include_dirs = [os.path.relpath(d) for d in include_dirs]
-
-    # Load compile commands from compilation database
-    compdb = _load_compdb("compile_commands.json")
-    commands = _get_compile_commands(compdb)
-    sources = _get_source_files(commands)
-
-    # Get extra header files to check
-    headers = _get_header_files(include_dirs)
-
-    # Filter out excluded files and files in the build directory
-    sources, headers = _filter_files(
-        sources, headers, config["exclude_patterns"]
-    )
+    # Tools are run in the build directory, so paths are relative to it
+    _message(f"Entering directory `{build_dir}'")
 
-    # Generate list of all tasks
-    tasks = []
+    # Load compile commands and find all the files to check
+    commands, sources, headers = _load_project(build_dir, config)
 
-    if config["iwyu"]:
-        for source in sources:
-            tasks += [_Task(_run_iwyu, source, commands[source])]
+    # Make a list of all files to check, with no command for extra headers
+    files = [(s, commands[s]) for s in sources]
+    if config["headers"]:
+        files += [(h, None) for h in headers]
 
-        if config["headers"]:
-            for header in headers:
-                tasks += [_Task(_run_iwyu, header, None)]
+    # Check the most expensive files first, based on the last run if possible
+    times_path = os.path.join(build_dir, _TIMES_NAME)
+    times = _load_task_times(times_path)
+    _sort_files(files, times, build_dir)
 
+    # Run all the tools for a file together, so they share the page cache
+    funcs = [_run_iwyu] if config["iwyu"] else []
     if config["tidy"]:
-        for source in sources:
-            tasks += [_Task(_run_clang_tidy, source, commands[source])]
-
-        if config["headers"]:
-            for header in headers:
-                tasks += [_Task(_run_clang_tidy, header, None)]
+        funcs += [_run_clang_tidy]
 
-    ret = _run_threads(
+    ret, new_times = _run_tasks(
         _Options(
             config["auto_headers"],
             build_dir,
+            config["cache"],
             config["headers"],
             _get_include_flags(commands),
             config["mapping_files"],
             config["verbose"],
         ),
-        tasks,
+        _generate_tasks(files, funcs),
         config["jobs"],
     )
 
-    _message(f"Leaving directory `{os.path.abspath(build_dir)}'")
-    os.chdir(orig_cwd)
+    if len(new_times) > 0:
+        times.update(new_times)
+        _save_task_times(times_path, times)
+
+    _message(f"Leaving directory `{build_dir}'")
 
     return ret
 
@@ -665,6 +928,14 @@ def main():
         help="run tools on individual headers",
     )
 
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        default=None,
+        action="store_false",
+        help="don't reuse or save cached results",
+    )
+
     parser.add_argument(
         "--no-iwyu",
         dest="iwyu",
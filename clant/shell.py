@@ -0,0 +1,69 @@
+"""
+Splitting and joining of shell command lines.
+
+These are equivalent to shlex.split() and shlex.join(), but much faster for
+the simple commands typically found in a compilation database.
+"""
+
+import re
+import shlex
+
+# Pattern for characters in an argument that shlex.quote() would escape
+_UNSAFE_RE = re.compile(r"[^\w@%+=:,./-]", re.ASCII)
+
+# Pattern for a word in a command with no quotes or escapes, which like
+# shlex.split() is only separated by ASCII spaces, tabs, and newlines
+_PLAIN_WORD_RE = re.compile(r"[^ \t\r\n]+")
+
+# Patterns for splitting commands like shlex.split(), where a word is a
+# sequence of parts which are unquoted text, quoted text, or an escape
+_PART = r"""[^ \t\r\n'"\\]+|'[^']*'|"(?:[^"\\]|\\.)*"|\\."""
+_PART_RE = re.compile(_PART, re.DOTALL)
+_WORD_RE = re.compile(rf"""(?:{_PART})+|(?P<error>['"\\])""", re.DOTALL)
+_ESCAPE_RE = re.compile(r'\\(["\\])')
+
+
+def join(cmd):
+    """Return a shell-escaped string from a command, like shlex.join()."""
+
+    return " ".join(
+        arg if arg and not _UNSAFE_RE.search(arg) else shlex.quote(arg)
+        for arg in cmd
+    )
+
+
+def _unquote_word(word):
+    """Remove quotes and escapes from a shell word like shlex does."""
+
+    if "'" not in word and '"' not in word and "\\" not in word:
+        return word
+
+    result = []
+    for part in _PART_RE.findall(word):
+        if part[0] == "'":
+            result.append(part[1:-1])
+        elif part[0] == '"':
+            result.append(_ESCAPE_RE.sub(r"\1", part[1:-1]))
+        elif part[0] == "\\":
+            result.append(part[1:])
+        else:
+            result.append(part)
+
+    return "".join(result)
+
+
+def split(command):
+    """Split a command string into a list of arguments like a shell."""
+
+    if "'" not in command and '"' not in command and "\\" not in command:
+        return _PLAIN_WORD_RE.findall(command)
+
+    words = []
+    for match in _WORD_RE.finditer(command):
+        if match.lastgroup == "error":
+            # Let shlex report the unterminated quote or escape
+            return shlex.split(command)
+
+        words.append(_unquote_word(match.group()))
+
+    return words